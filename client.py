@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Thin client for `frames.py serve`. Accepts the same arguments as frames.py and
+# forwards them to the daemon, falling back to running frames.py directly.
+# Only the standard library is imported here to keep startup cheap.
+
+import os, sys, json, socket
+from threading import Thread
+
+def socket_path() -> str:
+	run = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+	return os.environ.get('RIFE_HELPER_SOCKET') or f'{run}/rife-helper-{os.getuid()}.sock'
+
+def forward_stdin(sock: socket.socket) -> None:
+	# a null byte marks the end of stdin, since closing the connection cancels
+	try:
+		for line in sys.stdin:
+			sock.sendall(line.encode())
+		sock.sendall(b'\0')
+	except OSError:
+		pass
+
+def main(argv: list[str]) -> int:
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path())
+	except OSError:
+		sock.close()
+		here = os.path.dirname(os.path.realpath(__file__))
+		os.execv(sys.executable, [sys.executable, f'{here}/frames.py'] + argv)
+	with sock:
+		req = { 'cwd': os.getcwd(), 'argv': argv }
+		sock.sendall(json.dumps(req).encode() + b'\n')
+		Thread(target=forward_stdin, args=(sock,), daemon=True).start()
+		out = sys.stdout.buffer
+		code = b''
+		done = False
+		while chunk := sock.recv(1 << 16):
+			if not done:
+				# output is text, so a null byte marks the start of the exit status
+				data, sep, rest = chunk.partition(b'\0')
+				out.write(data)
+				out.flush()
+				done = sep != b''
+				chunk = rest
+			if done:
+				code += chunk
+	return int(code or 1)
+
+if __name__ == '__main__':
+	try:
+		sys.exit(main(sys.argv[1:]))
+	except KeyboardInterrupt: # closing the connection stops the command
+		sys.exit(130)
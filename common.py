@@ -1,10 +1,17 @@
-import os, json, subprocess, shutil, easing as eas
-from typing import Any, Self, Type
-from threading import Thread, active_count
-from wand.image import Image
+import os, json, struct, subprocess, shutil, time, easing as eas
+from typing import TYPE_CHECKING, Any, Iterator, Self, Type
+from threading import Thread, Condition, Event, Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
 from sys import argv
 
+if TYPE_CHECKING: # Wand loads ImageMagick, so only import it when pixels are needed
+	from wand.image import Image
+
 cwd = os.path.dirname(os.path.realpath(argv[0]))
+rife = os.environ.get('RIFE_BIN') or f'{cwd}/rife/build/rife-ncnn-vulkan'
+profiles = f'{cwd}/profiles.json'
+history = f'{cwd}/history.json'
 
 def float_or(s: str, fallback: float) -> float:
 	try:
@@ -12,6 +19,35 @@ def float_or(s: str, fallback: float) -> float:
 	except:
 		return fallback
 
+def copy_file(src: str, dst: str) -> None: # partly written frames are never visible
+	tmp = dst + '~'
+	try:
+		shutil.copyfile(src, tmp)
+		os.replace(tmp, dst)
+	except:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+def read_json(path: str) -> dict[str, Any]:
+	try:
+		with open(path, 'r') as f:
+			return json.load(f)
+	except (FileNotFoundError, json.JSONDecodeError): # a damaged file is started over
+		return {}
+
+def write_json(path: str, data: dict[str, Any], indent: str|None = None) -> None:
+	# through a temporary name, so an interrupted write leaves the old file intact
+	tmp = f'{path}.{os.getpid()}~'
+	try:
+		with open(tmp, 'w') as f:
+			json.dump(data, f, indent=indent)
+		os.replace(tmp, path)
+	except:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
 class Path(str):
 	def __new__(cls: Type[Self], s: str) -> Self:
 		return super().__new__(cls, s + ('/' if s[-1] != '/' else ''))
@@ -38,27 +74,33 @@ class Frame:
 		return (self.idx == other.idx)
 
 	def rename(self: Self, f: float, temp = False) -> None:
-		self.idx = f
-		s = (Frame.fmt % f) + ('.' if temp else '')
+		old = self.move(f, temp)
 		try:
-			os.rename(self.head + self.tail, self.head + s)
+			os.rename(old, self.head + self.tail)
 		except Exception as e:
 			print('rename: ' + str(e))
-		self.tail = s
+
+	def move(self: Self, f: float, temp = False) -> str:
+		# updates the index and name without touching the file
+		old = self.head + self.tail
+		self.idx = f
+		self.tail = (Frame.fmt % f) + ('.' if temp else '')
+		return old
 
 	def copy(self: Self, arg: Path|float, offset: float|None = None) -> None:
+		try:
+			copy_file(self.head + self.tail, self.dest(arg, offset))
+		except Exception as e:
+			print('copy: ' + str(e))
+
+	def dest(self: Self, arg: Path|float, offset: float|None = None) -> str:
 		o = offset is not None
-		new = (
+		return (
 			arg + (Frame.fmt % (self.idx + offset) if o else self.tail)
 		) if type(arg) == Path else (
 			self.head + (Frame.fmt % (arg + (offset if o else 0)))
 		) if type(arg) == float or type(arg) == int else ''
 
-		try:
-			shutil.copyfile(self.head + self.tail, new)
-		except Exception as e:
-			print('copy: ' + str(e))
-
 	def remove(self: Self) -> None:
 		try:
 			os.remove(self.head + self.tail)
@@ -69,8 +111,36 @@ class Frame:
 		if not self.key:
 			self.remove()
 
+	def size(self: Self) -> tuple[int, int]: # read from the png header
+		with open(self.head + self.tail, 'rb') as f:
+			head = f.read(24)
+		return struct.unpack('>II', head[16:24])
+
 Range = tuple[float|None, float|None]
 
+cancelled = Event() # set by the server when a client hangs up
+
+listings: dict[str, tuple[int, list[str]]] = {}
+listings_lock = Lock()
+
+def listing(head: Path) -> list[str]:
+	# sorted folder contents, reused while the folder's mtime is unchanged.
+	# Like git's racily clean index entries, a listing taken within a second of the
+	# last modification is not cached, since a coarse clock could hide a change
+	key = os.path.abspath(head)
+	mtime = os.stat(key).st_mtime_ns
+	with listings_lock:
+		cached = listings.get(key)
+	if cached is not None and cached[0] == mtime:
+		return cached[1]
+	tails = sorted(os.listdir(key))
+	with listings_lock:
+		if time.time_ns() - mtime > 1_000_000_000:
+			listings[key] = (mtime, tails)
+		else:
+			listings.pop(key, None)
+	return tails
+
 class Frames(list[Frame]):
 	def __init__(self: Self, head: Path, r: Range|None = None) -> None:
 		frames: list[Frame] = []
@@ -78,7 +148,7 @@ class Frames(list[Frame]):
 		self.wrap = None
 		if not os.path.exists(head):
 			return super().__init__(frames)
-		for i, tail in enumerate(sorted(os.listdir(head))):
+		for i, tail in enumerate(listing(head)):
 			name, ext = os.path.splitext(tail)
 			if ext == Frame.img:
 				frames.append(Frame(head, float_or(name, i), tail=tail))
@@ -98,9 +168,13 @@ class Frames(list[Frame]):
 				frames = [x for x in frames if r[0] <= x.idx and x.idx <= r[1]]
 		super().__init__(frames)
 
-	def copy_to(
-		self: Self, to: Path, lazy: bool = False, offset: float|None = None
+	def copy_to(self: Self,
+		to: Path, lazy: bool = False, offset: float|None = None,
+		ops: 'FileOps|None' = None,
 	) -> None:
+		if ops is None:
+			with FileOps() as ops:
+				return self.copy_to(to, lazy, offset, ops)
 		if not os.path.exists(to):
 			os.mkdir(to, 0o755)
 		elif not lazy:
@@ -109,17 +183,20 @@ class Frames(list[Frame]):
 				(self.range[0] + o) if self.range[0] is not None else None,
 				(self.range[1] + o) if self.range[1] is not None else None,
 			) if self.range is not None else None
+			ops.wait() # earlier copies may land in this range
 			for x in Frames(to, r):
-				x.remove()
+				ops.remove(x)
 		for x in self:
-			x.copy(to, offset)
+			ops.copy(x, to, offset)
 
-	def mark_for_pruning(self: Self, threshold: float) -> list[float]:
+	def mark_for_pruning(
+		self: Self, threshold: float, cap: int = 512 << 20
+	) -> list[float]:
 		diffs: list[float] = []
 		k = 0 # current keyframe index
-		key = Image(filename = self[k].head + self[k].tail)
-		for i in range(1, len(self)):
-			img = Image(filename = self[i].head + self[i].tail)
+		reader = iter(FrameReader(self, cap))
+		_, key = next(reader)
+		for i, (_, img) in enumerate(reader, 1):
 			diff = key.get_image_distortion(img, metric = 'root_mean_square')
 			diffs.append(diff)
 			s = f'{int(self[k].idx)},%s{int(self[i].idx)}: {diff}\033[0m'
@@ -136,6 +213,178 @@ class Frames(list[Frame]):
 		key.close()
 		return diffs
 
+	def fingerprints(self: Self, cap: int = 512 << 20) -> list[int]:
+		# perceptual hashes are cached in a hidden index file
+		if len(self) == 0:
+			return []
+		path = self[0].head + '.fingerprints.json'
+		index: dict[str, list[int]] = read_json(path)
+		stale: dict[str, list[int]] = {}
+		for x in self:
+			st = os.stat(x.head + x.tail)
+			if index.get(x.tail, [])[:2] != [st.st_mtime_ns, st.st_size]:
+				stale[x.tail] = [st.st_mtime_ns, st.st_size]
+		if stale:
+			print(f'Fingerprinting {len(stale)} of {len(self)} frames')
+			reader = FrameReader([x for x in self if x.tail in stale], cap)
+			for x, img in reader:
+				index[x.tail] = stale[x.tail] + [dhash(img)]
+				img.close()
+			tails = set(listing(self[0].head))
+			index = { k: v for k, v in index.items() if k in tails }
+			write_json(path, index)
+		return [index[x.tail][2] for x in self]
+
+def dhash(img: 'Image') -> int:
+	# 64-bit difference hash: each bit is whether a pixel of a 9x8 thumbnail
+	# is brighter than its left neighbor
+	img.resize(9, 8)
+	px = img.export_pixels(width=9, height=8, channel_map='I', storage='char')
+	h = 0
+	for y in range(8):
+		for x in range(8):
+			h = (h << 1) | (px[y * 9 + x] < px[y * 9 + x + 1])
+	return h
+
+class FileOps:
+	# operations on a path still in use wait for all pending ones,
+	# and failures are summarized on close
+	def __init__(self: Self, workers: int = 8) -> None:
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+		self.pending: list[tuple[str, str, Future]] = []
+		self.busy: set[str] = set()
+		self.failures: list[tuple[str, str, Exception]] = []
+		self.count = 0
+
+	def __enter__(self: Self) -> Self:
+		return self
+
+	def __exit__(self: Self, *_) -> None:
+		self.close()
+
+	def submit(self: Self, op: str, paths: tuple[str, ...], fn) -> None:
+		if not self.busy.isdisjoint(paths):
+			self.wait()
+		self.busy.update(paths)
+		self.count += 1
+		self.pending.append((op, paths[0], self.pool.submit(fn, *paths)))
+
+	def rename(self: Self, frame: Frame, f: float, temp = False) -> None:
+		old = frame.move(f, temp)
+		self.submit('rename', (old, frame.head + frame.tail), os.rename)
+
+	def renames(self: Self, frames: list[Frame], idxs: list[float]) -> None:
+		# temporary names first, so frames can take each other's names
+		for x, f in zip(frames, idxs):
+			self.rename(x, f, temp=True)
+		for x in frames:
+			self.rename(x, x.idx)
+
+	def copy(self: Self,
+		frame: Frame, arg: Path|float, offset: float|None = None
+	) -> None:
+		paths = (frame.head + frame.tail, frame.dest(arg, offset))
+		self.submit('copy', paths, copy_file)
+
+	def remove(self: Self, frame: Frame) -> None:
+		self.submit('remove', (frame.head + frame.tail,), os.remove)
+
+	def wait(self: Self) -> None:
+		for op, path, future in self.pending:
+			e = future.exception()
+			if e is not None:
+				self.failures.append((op, path, e))
+		self.pending.clear()
+		self.busy.clear()
+
+	def close(self: Self) -> None:
+		self.wait()
+		self.pool.shutdown()
+		if len(self.failures) == 0:
+			return
+		groups: dict[str, list[str]] = {}
+		for op, path, e in self.failures:
+			reason = e.strerror if isinstance(e, OSError) and e.strerror else str(e)
+			groups.setdefault(f'{op}: {reason}', []).append(path)
+		print(f'{len(self.failures)} of {self.count} file operations failed')
+		for reason, paths in groups.items():
+			more = f' (+{len(paths) - 3} more)' if len(paths) > 3 else ''
+			print(f'  {reason} ({len(paths)}): {", ".join(paths[:3])}{more}')
+
+class FrameReader:
+	# decodes up to `ahead` frames or roughly `cap` bytes ahead of the consumer,
+	# which closes them
+	def __init__(self: Self, frames: list[Frame], cap: int, ahead: int = 8) -> None:
+		self.frames = frames
+		self.cap = cap
+		self.ahead = max(1, ahead)
+		self.queue: deque[tuple[Frame, 'Image|Exception', int]] = deque()
+		self.size = 0
+		self.done = False
+		self.stop = False
+		self.cond = Condition()
+
+	def fill(self: Self) -> None:
+		from wand.image import Image
+		from wand.version import MAGICK_HDRI, QUANTUM_DEPTH
+		# bytes per channel: HDRI builds keep floats, at least 4 bytes wide
+		depth = max(4, QUANTUM_DEPTH // 4) if MAGICK_HDRI else QUANTUM_DEPTH // 8
+		need = 0 # frames in a sequence share dimensions, so guess from the last one
+		for x in self.frames:
+			with self.cond:
+				self.cond.wait_for(lambda: self.stop or not self.queue or (
+					len(self.queue) < self.ahead and self.size + need <= self.cap))
+				if self.stop:
+					break
+			try:
+				img: 'Image|Exception' = Image(filename = x.head + x.tail)
+				# ImageMagick keeps up to 4 channels for a png
+				need = img.width * img.height * 4 * depth
+			except Exception as e:
+				img = e
+			with self.cond:
+				if self.stop:
+					if not isinstance(img, Exception):
+						img.close()
+					break
+				self.queue.append((x, img, need))
+				self.size += need
+				self.cond.notify_all()
+				if isinstance(img, Exception):
+					break
+		with self.cond:
+			self.done = True
+			self.cond.notify_all()
+
+	def close(self: Self) -> None:
+		with self.cond:
+			self.stop = True
+			while self.queue:
+				_, img, _ = self.queue.popleft()
+				if not isinstance(img, Exception):
+					img.close()
+			self.size = 0
+			self.cond.notify_all()
+
+	def __iter__(self: Self) -> Iterator[tuple[Frame, 'Image']]:
+		thread = Thread(target=self.fill, daemon=True)
+		thread.start()
+		try:
+			while True:
+				with self.cond:
+					self.cond.wait_for(lambda: self.done or self.queue)
+					if not self.queue:
+						break
+					x, img, need = self.queue.popleft()
+					self.size -= need
+					self.cond.notify_all()
+				if isinstance(img, Exception):
+					raise img
+				yield x, img
+		finally:
+			self.close()
+			thread.join()
+
 class Interpolator:
 	def __init__(self: Self,
 		ease: dict[str, Any]|None, jobs: int|None, model: str|None, approx: float|None
@@ -148,28 +397,144 @@ class Interpolator:
 		self.approx = approx or 0.125
 		self.margin = 1 + self.approx * 2
 		self.error = False
+		self.auto = jobs is None
+		self.threads: str|None = None # load:proc:save thread counts passed to rife
+		self.tile: int|None = None
+		self.timings: list[float] = [] # seconds taken by each rife call
+		self.dry = False # only count what would be generated, without running rife
+		self.calls = 0
+		self.live = 0
+		self.peak = 0
+		self.discarded = 0
+		self.workers = 1 # threads interpolating, counting the caller
+		self.lock = Lock()
+
+	def spawn(self: Self, func, lo: Frame, hi: Frame) -> Thread|None:
+		# start a thread if fewer than `jobs` are busy, other threads don't count
+		with self.lock:
+			if self.workers >= self.jobs:
+				return None
+			self.workers += 1
+		def run() -> None:
+			try:
+				func(self, lo, hi)
+			finally:
+				with self.lock:
+					self.workers -= 1
+		t = Thread(target=run)
+		t.start()
+		return t
+
+	def profile_key(self: Self, frame: Frame) -> str:
+		w, h = frame.size()
+		return f'{self.model} {w}x{h}'
+
+	def load_profile(self: Self, frame: Frame) -> dict[str, Any]|None:
+		# settings saved by autotune, jobs given on the command line take precedence
+		prof = read_json(profiles).get(self.profile_key(frame))
+		if prof is None:
+			return None
+		if self.auto:
+			self.jobs = prof['jobs']
+		self.threads, self.tile = prof['threads'], prof['tile']
+		return prof
+
+	def save_profile(self: Self, frame: Frame) -> None:
+		data = read_json(profiles)
+		data[self.profile_key(frame)] = {
+			'jobs': self.jobs, 'threads': self.threads, 'tile': self.tile }
+		write_json(profiles, data, '\t')
+
+	def history_key(self: Self, frame: Frame) -> str:
+		return f'{self.profile_key(frame)} j{self.jobs}'
+
+	def save_history(self: Self, key: str, wall: float) -> None:
+		if len(self.timings) == 0:
+			return
+		data = read_json(history)
+		rec = data.setdefault(key,
+			{ 'calls': 0, 'latency': 0.0, 'wall': 0.0 })
+		rec['calls'] += len(self.timings)
+		rec['latency'] += sum(self.timings)
+		rec['wall'] += wall
+		write_json(history, data, '\t')
+
+	def seconds_per_call(self: Self, frame: Frame) -> float|None:
+		data = read_json(history)
+		rec = data.get(self.history_key(frame))
+		if rec is not None and rec['calls'] > 0:
+			return rec['wall'] / rec['calls']
+		# without a record for this job count, share the mean latency among jobs
+		base = self.profile_key(frame) + ' j'
+		recs = [v for k, v in data.items() if k.startswith(base) and v['calls'] > 0]
+		if len(recs) == 0:
+			return None
+		latency = sum(v['latency'] for v in recs) / sum(v['calls'] for v in recs)
+		return latency / self.jobs
+
+	def command(self: Self, lo: str, hi: str, out: str) -> list[str]:
+		cmd = [ rife, '-m', f'{cwd}/rife/models/{self.model}',
+			'-0', lo, '-1', hi, '-o', out ]
+		if self.threads:
+			cmd += ['-j', self.threads]
+		if self.tile:
+			cmd += ['-t', str(self.tile)]
+		return cmd
+
+	def bench(
+		self: Self, pairs: list[tuple[Frame, Frame]], out: str, calls: int
+	) -> tuple[float, float]|None:
+		# returns calls per second and mean seconds per call
+		latency: list[float] = []
+		failed = False
+		def work(n: int) -> None:
+			nonlocal failed
+			for i in range(n, calls, self.jobs):
+				lo, hi = pairs[i % len(pairs)]
+				start = time.perf_counter()
+				result = subprocess.run(self.command(
+					lo.head + lo.tail, hi.head + hi.tail, f'{out}{n}{Frame.img}',
+				), capture_output=True)
+				latency.append(time.perf_counter() - start)
+				failed = failed or result.returncode != 0
+		start = time.perf_counter()
+		threads = [Thread(target=work, args=(n,)) for n in range(self.jobs)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		wall = time.perf_counter() - start
+		if failed:
+			return None
+		return calls / wall, sum(latency) / len(latency)
 
 	def gen_frame(self: Self, lo: Frame, hi: Frame) -> Frame:
 		pct = (lo.pct + hi.pct) / 2
 		f = self.ease.idx_from_pct(pct)
 		mid = Frame(lo.head, f, pct=pct)
 		mid.key = (abs(f - round(f)) <= self.approx)
+		if self.dry:
+			# rife fails when asked to overwrite one of its inputs
+			self.error = self.error or mid.tail in (lo.tail, hi.tail)
+			self.calls += 1
+			self.live += 1
+			self.peak = max(self.peak, self.live)
+			return mid
 		def fmt(num):
 			return f'%.{ 6 - len(str(int(num))) }f' % num
 		print(f'{fmt(lo.idx)}\033[92m {fmt(mid.idx)}\033[0m {fmt(hi.idx)}')
-		result = subprocess.run([ f'{cwd}/rife/build/rife-ncnn-vulkan',
-			'-m', f'{cwd}/rife/models/{self.model}',
-			'-0', lo.head + lo.tail,
-			'-1', hi.head + hi.tail,
-			'-o', mid.head + mid.tail,
-		], capture_output=True, text=True)
+		start = time.perf_counter()
+		result = subprocess.run(self.command(
+			lo.head + lo.tail, hi.head + hi.tail, mid.head + mid.tail,
+		), capture_output=True, text=True)
+		self.timings.append(time.perf_counter() - start)
 		if result.returncode != 0:
 			print(result.stderr.splitlines()[-1])
 			self.error = True
 		return mid
 
 	def gen_frames(self: Self, lo: Frame, hi: Frame) -> None:
-		if self.error:
+		if self.error or cancelled.is_set():
 			return
 		dif = abs(hi.idx - lo.idx)
 		if ( int(lo.idx) == int(hi.idx) # ex: 2 and 2.9 (no new keyframes)
@@ -177,16 +542,17 @@ class Interpolator:
 			or (lo.key != hi.key and dif < 1) # ex: 1.9 (skip) 2.5 (3) 3.5
 		): return
 		mid = self.gen_frame(lo, hi)
-		t = None
-		if active_count() < self.jobs:
-			t = Thread(target=Interpolator.gen_frames, args=(self, lo, mid))
-			t.start()
-		else:
+		t = None if self.dry else self.spawn(Interpolator.gen_frames, lo, mid)
+		if not t:
 			self.gen_frames(lo, mid)
 		self.gen_frames(mid, hi)
 		if t:
 			t.join()
-		mid.prune()
+		if not self.dry:
+			mid.prune()
+		elif not mid.key:
+			self.discarded += 1
+			self.live -= 1
 
 def ffprobe(file: str) -> dict[str, Any]:
 	probe = subprocess.run([ 'ffprobe', '-print_format', 'json',
@@ -1,61 +1,68 @@
 #!/usr/bin/env python3
 
-import os, re, sys, argparse, subprocess, common as cmn, easing as eas
-from threading import Thread, active_count
-from datetime import datetime
+import os, re, sys, json, time, argparse, subprocess, tempfile, traceback
+import common as cmn, easing as eas
+from threading import Thread, Lock, Event
+from datetime import datetime, timedelta
+from bisect import bisect_left
 
 ################################################################################
 # Command Functions
 
+def read_cap(args: argparse.Namespace) -> int:
+	return int((args.cap or 512) * (1 << 20))
+
 def cmd_multiply(args: argparse.Namespace) -> None:
 	a = args.num or 1
 	f = cmn.Frames(args.dir, args.range)
-	for x in (f if a < 1 else reversed(f)):
-		x.rename(x.idx * a)
+	with cmn.FileOps() as ops:
+		ops.renames(f, [x.idx * a for x in f])
 
 def cmd_add(args: argparse.Namespace) -> None:
 	a = args.num or 0
 	f = cmn.Frames(args.dir, args.range)
-	for x in (f if a < 0 else reversed(f)):
-		x.rename(x.idx + a)
+	with cmn.FileOps() as ops:
+		ops.renames(f, [x.idx + a for x in f])
 
 def cmd_sort(args: argparse.Namespace) -> None:
-	for i, x in enumerate(cmn.Frames(args.dir, args.range)):
-		x.rename(i)
+	f = cmn.Frames(args.dir, args.range)
+	with cmn.FileOps() as ops:
+		ops.renames(f, list(range(len(f))))
 
 def cmd_clean(args: argparse.Namespace) -> None:
 	d, r = args.div, args.rem or 0
-	fn = ( (lambda _, x: x.remove()) if d is None
-		else (lambda i, x: x.remove() if i % d == r else None) if args.invert
-		else (lambda i, x: x.remove() if i % d != r else None) )
-	for i, x in enumerate(cmn.Frames(args.dir, args.range)):
-		fn(i, x)
+	fn = ( (lambda _: True) if d is None
+		else (lambda i: i % d == r) if args.invert
+		else (lambda i: i % d != r) )
+	with cmn.FileOps() as ops:
+		for i, x in enumerate(cmn.Frames(args.dir, args.range)):
+			if fn(i):
+				ops.remove(x)
 
 def cmd_save(args: argparse.Namespace) -> None:
-	if len(args.nums) == 0:
-		cmn.Frames(args.dir, (None, None)).copy_to(args.backup, args.lazy, args.offset)
-		return
-	for a in [s.split(':') for s in args.nums]:
-		if len(a) >= 2:
-			r = (float(a[0]), float(a[1]))
-			cmn.Frames(args.dir, r).copy_to(args.backup, args.lazy, args.offset)
-		elif len(a) >= 1:
-			cmn.Frame(args.dir, float(a[0])).copy(args.backup, args.offset)
+	with cmn.FileOps() as ops:
+		copy_ranges(args.dir, args.backup, args, ops)
 
 def cmd_load(args: argparse.Namespace) -> None:
+	with cmn.FileOps() as ops:
+		copy_ranges(args.backup, args.dir, args, ops)
+
+def copy_ranges(
+	src: cmn.Path, dst: cmn.Path, args: argparse.Namespace, ops: cmn.FileOps
+) -> None:
 	if len(args.nums) == 0:
-		cmn.Frames(args.backup, (None, None)).copy_to(args.dir, args.lazy, args.offset)
+		cmn.Frames(src, (None, None)).copy_to(dst, args.lazy, args.offset, ops)
 		return
 	for a in [s.split(':') for s in args.nums]:
 		if len(a) >= 2:
 			r = (float(a[0]), float(a[1]))
-			cmn.Frames(args.backup, r).copy_to(args.dir, args.lazy, args.offset)
+			cmn.Frames(src, r).copy_to(dst, args.lazy, args.offset, ops)
 		elif len(a) >= 1:
-			cmn.Frame(args.backup, float(a[0])).copy(args.dir, args.offset)
+			ops.copy(cmn.Frame(src, float(a[0])), dst, args.offset)
 
 def cmd_prune(args: argparse.Namespace) -> None:
 	frames = cmn.Frames(args.dir, args.range)
-	frames.mark_for_pruning(args.threshold or 0.015)
+	frames.mark_for_pruning(args.threshold or 0.015, read_cap(args))
 	if args.dryrun:
 		return
 	frames[-1].key = True
@@ -66,7 +73,7 @@ def cmd_weigh(args: argparse.Namespace) -> None:
 	msg = ''
 	for r in args.ranges:
 		frames = cmn.Frames(args.dir, r)
-		diffs = frames.mark_for_pruning(0)
+		diffs = frames.mark_for_pruning(0, read_cap(args))
 		total = sum(diffs)
 		accum = 0
 		line = ''
@@ -82,10 +89,137 @@ def cmd_weigh(args: argparse.Namespace) -> None:
 			msg += f'\nmv{line}'
 	print(msg)
 
+def cmd_loop(args: argparse.Namespace) -> None:
+	frames = cmn.Frames(args.dir, args.range)
+	n = len(frames)
+	if n < 3:
+		raise ValueError('Directory must contain at least 3 images')
+	hashes = frames.fingerprints(read_cap(args))
+	gap = int(args.gap) if args.gap is not None else max(2, n // 4)
+	count = args.count or 5
+
+	# multi-index hashing: hashes within 7 bits of each other share at least one
+	# of their 8 bytes, so only frames in a shared bucket need to be compared.
+	# Crowded buckets (static footage) are thinned to 256 evenly spaced frames,
+	# since frames alike enough to crowd a bucket stand in for their neighbors
+	buckets: dict[tuple[int, int], list[int]] = {}
+	for i, h in enumerate(hashes):
+		for b in range(8):
+			buckets.setdefault((b, (h >> (b * 8)) & 0xff), []).append(i)
+	pairs: set[tuple[int, int]] = set()
+	for ids in buckets.values():
+		ids = ids[::-(-len(ids) // 256)]
+		for a, i in enumerate(ids):
+			pairs.update((i, j) for j in ids[bisect_left(ids, i + gap, a + 1):])
+
+	def score(i: int, j: int) -> float:
+		# compare the neighbors as well, so the motion carries over the seam
+		ks = [k for k in (-1, 0, 1) if i + k >= 0 and j + k < n]
+		return sum((hashes[i + k] ^ hashes[j + k]).bit_count() for k in ks) / len(ks)
+
+	ranked = sorted(pairs, key=lambda p: (score(*p), p[0] - p[1]))
+	picks: list[tuple[int, int]] = []
+	for i, j in ranked:
+		if len(picks) >= count * 2:
+			break
+		if all(abs(i - a) > 2 or abs(j - b) > 2 for a, b in picks):
+			picks.append((i, j))
+	if len(picks) == 0:
+		sys.exit(f'No loop candidates at least {gap} frames long')
+
+	from wand.image import Image
+	results: list[tuple[float, int, int]] = []
+	for i, j in picks:
+		with Image(filename = frames[i].head + frames[i].tail) as lo, \
+			Image(filename = frames[j].head + frames[j].tail) as hi:
+			diff = lo.get_image_distortion(hi, metric = 'root_mean_square')
+		results.append((diff, i, j))
+	results.sort(key=lambda r: (r[0], score(r[1], r[2]), r[1] - r[2]))
+	for diff, i, j in results[:count]:
+		print(f'{frames[i].idx:g}:{frames[j].idx:g} '
+			f'length: {j - i}, hash: {score(i, j):.2f}, distortion: {diff}')
+
+	_, i, j = results[0]
+	if args.trim:
+		# only frames within the range are removed, after saving them to the backup
+		lo, hi = frames[i].idx, frames[j].idx
+		cut = frames[:i] + frames[j + 1:]
+		kept = frames[i:j + 1]
+		with cmn.FileOps() as ops:
+			if cut and not os.path.exists(args.backup):
+				os.mkdir(args.backup, 0o755)
+			for x in cut:
+				ops.copy(x, args.backup)
+			ops.wait()
+			if ops.failures:
+				sys.exit('Could not back up the frames outside the loop. Aborting')
+			for x in cut:
+				ops.remove(x)
+		print(f'\nTrimmed to {lo:g}:{hi:g}, '
+			f'{len(cut)} removed frames saved to {args.backup}')
+		if len(cmn.Frames(args.dir)) == len(kept):
+			with cmn.FileOps() as ops:
+				ops.renames(kept, [x.idx - lo for x in kept])
+			print('Reindexed from 0')
+		else:
+			print('Frames outside the range remain, so the loop was not reindexed')
+
+	# a wrapped range drops the last frame of the folder as a duplicate of the first,
+	# so it only applies once the loop fills the folder
+	folder = cmn.Frames(args.dir)
+	if j - i < 2 or folder[0] != frames[i] or folder[-1] != frames[j]:
+		msg = ('\nThe best loop does not fill the project folder. '
+			'Trim to it with -t to get a wrapped range')
+		if args.apply:
+			sys.exit(msg)
+		print(msg)
+		return
+	seam = f'{frames[j - 1].idx:g}:{frames[i + 1].idx:g}'
+	print(f'\nSmooth the seam with: gen -r {seam}')
+	if args.apply:
+		main(['gen', '-d', args.dir, '-r', seam])
+
 def cmd_generate(args: argparse.Namespace) -> None:
+	scale_range(args)
+	if args.estimate:
+		report(estimate(args))
+		return
+	if args.watch is not None:
+		r = args.range
+		if args.zoh or args.single or args.open:
+			raise ValueError('Watch mode cannot be combined with -z, -s or -o')
+		if r is not None and None not in r and r[0] > r[1]:
+			raise ValueError('Watch mode cannot be used with a wrapped range')
+	while True:
+		erp, keys = generate(args)
+		if args.watch is None or not watch(args, erp, keys):
+			break
+
+def scale_range(args: argparse.Namespace) -> None:
 	if args.range is not None and args.num is not None:
 		r, x = args.range, args.num
 		args.range = cmn.Range(l * x if l is not None else None for l in r)
+
+def ease_range(
+	args: argparse.Namespace, ease: eas.Easing, frames: cmn.Frames
+) -> None:
+	lo, hi = frames[0], frames[-1]
+	r: cmn.Range|None = args.range
+	# after the offset is applied, a wrapped range is eased over the frames it covers
+	if r is not None and (None in r or r[0] <= r[1]):
+		ease.set_idx_range(
+			r[0] if r[0] is not None else lo.idx,
+			r[1] if r[1] is not None else hi.idx,
+		)
+		lo.pct, hi.pct = ease.pct_from_idx(lo.idx), ease.pct_from_idx(hi.idx)
+	else:
+		ease.set_idx_range(lo.idx, hi.idx)
+		lo.pct, hi.pct = 0.0, 1.0
+
+def generate(
+	args: argparse.Namespace
+) -> tuple[cmn.Interpolator, list[tuple[cmn.Frame, cmn.Frame]]]:
+	backup = None
 	if args.load:
 		backup = args.load if type(args.load) == cmn.Path else args.backup
 		cmn.Frames(backup, args.range).copy_to(args.dir)
@@ -95,8 +229,9 @@ def cmd_generate(args: argparse.Namespace) -> None:
 	frames = cmn.Frames(args.dir, args.range)
 
 	if args.clear and len(frames) > 2:
-		for x in frames[1:-1]:
-			x.remove()
+		with cmn.FileOps() as ops:
+			for x in frames[1:-1]:
+				ops.remove(x)
 		frames[:] = [frames[0], frames[-1]]
 		if args.pause:
 			input(f'\nIntermediate frames deleted. Press a key to continue\n')
@@ -136,7 +271,14 @@ def cmd_generate(args: argparse.Namespace) -> None:
 			input(f'\nOffset of {wrap} applied. Press a key to continue\n')
 		frames = cmn.Frames(args.dir, frames.range)
 
+	# pair each keyframe with the file it was loaded from, before any reindexing
+	src = {x.idx: x for x in cmn.Frames(backup, args.range)} if backup else {}
+	keys = [(src.get(x.idx, x), x) for x in frames]
+
 	erp = cmn.Interpolator(args.ease, args.jobs, args.model, args.approx)
+	erp.load_profile(frames[0])
+	tag = erp.history_key(frames[0]) # before the offset removal renames it
+	wall = 0.0
 	ease = erp.ease
 	s_range = 'Range: ' + (
 		str(frames.range or f'({frames[0].idx}, {frames[-1].idx})')) + '\n'
@@ -152,14 +294,16 @@ def cmd_generate(args: argparse.Namespace) -> None:
 			else cmn.Interpolator.gen_frames)
 
 		def process(lo: cmn.Frame, hi: cmn.Frame):
-			if active_count() < erp.jobs:
-				t = Thread(target=func, args=(erp, lo, hi))
-				t.start()
+			t = erp.spawn(func, lo, hi)
+			if t:
 				threads.append(t)
 			else:
 				func(erp, lo, hi)
 
-		print(f'\n{s_range}Model: {erp.model}, Jobs: {erp.jobs}\n{ease.info()}\n')
+		tuned = (f', Threads: {erp.threads or "default"}, Tile: {erp.tile or "default"}'
+			if erp.threads or erp.tile else '')
+		print(f'\n{s_range}Model: {erp.model}, Jobs: {erp.jobs}{tuned}\n{ease.info()}\n')
+		start = time.perf_counter()
 		if ease.segmented:
 			for i in range(len(frames) - 1):
 				lo, hi = frames[i], frames[i + 1]
@@ -167,27 +311,16 @@ def cmd_generate(args: argparse.Namespace) -> None:
 				ease.set_idx_range(lo.idx, hi.idx)
 				process(lo, hi)
 		else:
-			lo, hi = frames[0], frames[-1]
-			if args.range is not None:
-				r: cmn.Range = args.range
-				ease.set_idx_range(
-					r[0] if r[0] is not None else lo.idx,
-					r[1] if r[1] is not None else hi.idx,
-				)
-				lo.pct, hi.pct = ease.pct_from_idx(lo.idx), ease.pct_from_idx(hi.idx)
-			else:
-				ease.set_idx_range(lo.idx, hi.idx)
-				lo.pct, hi.pct = 0.0, 1.0
+			ease_range(args, ease, frames)
 
 			# reindex keyframes to conform to the overarching easing
-			# give them temporary names first to avoid naming collisions
 			for x in frames[1:-1]:
 				x.pct = ease.pct_from_lin(x.idx)
-				f = ease.idx_from_pct(x.pct)
-				x.rename(f, temp=True)
-				x.key = (abs(f - round(f)) <= erp.approx)
+			idxs = [ease.idx_from_pct(x.pct) for x in frames[1:-1]]
+			with cmn.FileOps() as ops:
+				ops.renames(frames[1:-1], idxs)
 			for x in frames[1:-1]:
-				x.rename(x.idx, temp=False)
+				x.key = (abs(x.idx - round(x.idx)) <= erp.approx)
 			if args.pause and ease.func != eas.Easing.linear:
 				input('\nReindexed for easing. Press a key to continue\n')
 
@@ -195,11 +328,13 @@ def cmd_generate(args: argparse.Namespace) -> None:
 				process(frames[i], frames[i + 1])
 		for t in threads:
 			t.join()
-		if not args.single:
+		# while watching, keyframes stay on disk to regenerate from
+		if not args.single and args.watch is None:
 			for x in frames:
 				x.prune()
 		if erp.error:
 			sys.exit('RIFE encountered an error. Aborting')
+		wall = time.perf_counter() - start
 
 	hi = args.range[1] if args.range is not None else None
 	if wrap is not None and hi is not None:
@@ -207,6 +342,242 @@ def cmd_generate(args: argparse.Namespace) -> None:
 			input('\nPress a key to begin offset removal\n')
 		for x in cmn.Frames(args.dir, frames.range)[-(int(hi) + 1):]:
 			x.rename(max(0, x.idx - wrap))
+	erp.save_history(tag, wall)
+	return erp, keys
+
+def estimate(args: argparse.Namespace) -> dict[str, float]:
+	# simulate gen on the current keyframes, without running rife or touching files
+	# names are kept in step with indexes, since gen_frame compares them
+	source = (args.load if type(args.load) == cmn.Path else args.backup
+		) if args.load else args.dir
+	frames = cmn.Frames(source, args.range)
+	if args.clear and len(frames) > 2:
+		frames[:] = [frames[0], frames[-1]]
+	if len(frames) < 2:
+		raise ValueError('Directory must contain at least 2 images')
+	sizes = [os.stat(x.head + x.tail).st_size for x in frames]
+	size = sum(sizes) / len(sizes)
+
+	if args.open:
+		old_end = frames[-2].idx
+		frames[-2].move(frames[-1].idx - 1)
+		frames[:] = frames[:-1]
+		frames.range = (frames[0].idx, frames[-1].idx)
+		b = frames[0].idx
+		m = (frames[-1].idx - b) / (old_end - b)
+		for x in frames[1:-1]:
+			x.move(m * (x.idx - b) + b)
+	if type(frames.wrap) == int:
+		# the last frame duplicates the first, and the beginning moves past the end
+		wrap = frames[frames.wrap - 1].idx
+		beg = frames[frames.wrap:]
+		for x in beg:
+			x.move(x.idx + wrap)
+		frames[:] = frames[:frames.wrap - 1] + beg
+
+	erp = cmn.Interpolator(args.ease, args.jobs, args.model, args.approx)
+	erp.load_profile(frames[0])
+	erp.dry = True
+	ease = erp.ease
+	s_range = 'Range: ' + (
+		str(frames.range or f'({frames[0].idx}, {frames[-1].idx})')) + '\n'
+	print(f'\n{s_range}Model: {erp.model}, Jobs: {erp.jobs}\n{ease.info()}\n')
+	func = (cmn.Interpolator.gen_frame if args.single
+		else cmn.Interpolator.gen_frames)
+	copies = 0
+	if args.zoh:
+		for i in range(len(frames) - 1):
+			copies += max(0, int(frames[i + 1].idx) - int(frames[i].idx + 1))
+	elif ease.segmented:
+		for i in range(len(frames) - 1):
+			lo, hi = frames[i], frames[i + 1]
+			lo.pct, hi.pct = 0.0, 1.0
+			ease.set_idx_range(lo.idx, hi.idx)
+			func(erp, lo, hi)
+	else:
+		ease_range(args, ease, frames)
+		for x in frames[1:-1]:
+			x.pct = ease.pct_from_lin(x.idx)
+			x.move(ease.idx_from_pct(x.pct))
+			x.key = (abs(x.idx - round(x.idx)) <= erp.approx)
+		for i in range(len(frames) - 1):
+			func(erp, frames[i], frames[i + 1])
+	pruned = 0 if args.single else sum(not x.key for x in frames)
+	if erp.error:
+		print('\033[91mRIFE would be asked to overwrite a keyframe, '
+			'and gen would abort here\033[0m')
+
+	spc = erp.seconds_per_call(frames[0])
+	return {
+		'calls': erp.calls,
+		'created': erp.calls + copies,
+		'discarded': erp.discarded,
+		'kept': erp.calls + copies - erp.discarded,
+		'disk': (erp.calls + copies - erp.discarded - pruned) * size,
+		'peak': erp.peak * size,
+		'seconds': erp.calls * spc if spc is not None else float('nan'),
+	}
+
+def report(est: dict[str, float]) -> None:
+	secs = est['seconds']
+	print(f'Inference calls: {est["calls"]:g}\n'
+		f'Intermediate frames: {est["created"]:g} created, '
+		f'{est["discarded"]:g} discarded, {est["kept"]:g} kept\n'
+		f'Disk space: {est["disk"] / (1 << 20):.1f} MiB, '
+		f'{est["peak"] / (1 << 20):.1f} MiB peak for intermediates\n'
+		'Wall-clock time: ' + ('unknown, no timing history' if secs != secs
+			else str(timedelta(seconds=round(secs)))) + '\n')
+
+def watch(
+	args: argparse.Namespace,
+	erp: cmn.Interpolator,
+	keys: list[tuple[cmn.Frame, cmn.Frame]],
+) -> bool:
+	# returns True if keyframes were added or removed, which needs a full run
+	ease = erp.ease
+	pending: set[int] = set()
+	lock = Lock()
+	ready = Event()
+	stop = False
+
+	def stat(x: cmn.Frame) -> tuple[int, int]|None:
+		try:
+			st = os.stat(x.head + x.tail)
+			return (st.st_mtime_ns, st.st_size)
+		except OSError:
+			return None
+
+	def names() -> set[str]|None:
+		if not args.load:
+			return None
+		return { x.tail for x in cmn.Frames(keys[0][0].head, args.range) }
+
+	def regen(dirty: set[int]) -> None:
+		segs = sorted({ (j, j + 1) for i in dirty for j in (i - 1, i)
+			if 0 <= j < len(keys) - 1 })
+		ends = sorted({ i for seg in segs for i in seg })
+		for i in ends:
+			src, dst = keys[i]
+			if src is not dst and (i in dirty or stat(dst) is None):
+				cmn.copy_file(src.head + src.tail, dst.head + dst.tail)
+			elif stat(dst) is None:
+				print(f'Keyframe {dst.idx:g} is missing, skipping its segments')
+				segs = [seg for seg in segs if i not in seg]
+		# compare names, since indexes parsed back from names are rounded
+		key_tails = { keys[i][1].tail for i in ends }
+		for a, b in segs:
+			lo, hi = keys[a][1], keys[b][1]
+			for x in cmn.Frames(args.dir, (lo.idx, hi.idx)):
+				if x.tail not in key_tails:
+					x.remove()
+		erp.error = False
+		start = datetime.now()
+		for a, b in segs:
+			lo, hi = keys[a][1], keys[b][1]
+			if ease.segmented:
+				lo.pct, hi.pct = 0.0, 1.0
+				ease.set_idx_range(lo.idx, hi.idx)
+			erp.gen_frames(lo, hi)
+		secs = (datetime.now() - start).total_seconds()
+		spans = ', '.join(f'{keys[a][1].idx:g}:{keys[b][1].idx:g}' for a, b in segs)
+		print(f'\nRegenerated {len(segs)} segment(s) in {secs:.1f}s: {spans or "none"}'
+			+ (', RIFE encountered an error' if erp.error else '') + '\n')
+
+	def work() -> None:
+		while True:
+			ready.wait()
+			with lock:
+				dirty = set(pending)
+				pending.clear()
+				ready.clear()
+			if stop:
+				return
+			try:
+				regen(dirty)
+			except Exception as e:
+				print('watch: ' + str(e))
+
+	seen = [stat(src) for src, _ in keys]
+	last = list(seen)
+	listed = names()
+	worker = Thread(target=work, daemon=True)
+	worker.start()
+	print(f'Watching {len(keys)} keyframes. Press Ctrl-C to stop\n')
+	try:
+		while True:
+			time.sleep(args.watch)
+			if names() != listed:
+				print('\nKeyframes were added or removed. Regenerating everything\n')
+				return True
+			now = [stat(src) for src, _ in keys]
+			# wait for a file to stop changing before regenerating around it,
+			# and ignore non-key frames being pruned from the project folder
+			dirty = { i for i in range(len(keys)) if now[i] is not None
+				and now[i] == last[i] and now[i] != seen[i] }
+			last = now
+			if dirty:
+				for i in dirty:
+					seen[i] = now[i]
+					print(f'Keyframe {keys[i][0].idx:g} changed')
+				with lock:
+					pending.update(dirty)
+					ready.set()
+	except KeyboardInterrupt:
+		return False
+	finally:
+		stop = True
+		ready.set()
+		worker.join()
+		for _, x in keys:
+			if stat(x) is not None:
+				x.prune()
+
+def cmd_autotune(args: argparse.Namespace) -> None:
+	frames = cmn.Frames(args.dir, args.range)
+	if len(frames) < 2:
+		raise ValueError('Directory must contain at least 2 images')
+	pairs = [(frames[i], frames[i + 1]) for i in range(min(len(frames) - 1, 8))]
+	erp = cmn.Interpolator(None, 1, args.model, None)
+	most = args.jobs or 8
+
+	def measure(jobs: int, threads: str|None, tile: int|None) -> float:
+		erp.jobs, erp.threads, erp.tile = jobs, threads, tile
+		res = erp.bench(pairs, out, args.calls or max(4, jobs * 2))
+		s = f'Jobs: {jobs}, Threads: {threads or "default"}, Tile: {tile or "default"}'
+		if res is None:
+			print(f'{s}\033[91m failed\033[0m')
+			return 0
+		print(f'{s}\033[92m {res[0]:.3f} calls/s\033[0m, {res[1]:.3f} s/call')
+		return res[0]
+
+	with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+		out = cmn.Path(tmp)
+		print(f'\nCalibrating {erp.profile_key(frames[0])}\n')
+		erp.bench(pairs, out, 1) # warm up file and driver caches
+		rate = measure(1, None, None)
+		if rate == 0:
+			sys.exit('RIFE encountered an error. Aborting')
+		best = (rate, None, None)
+		# tune one setting at a time, keeping the best of the previous ones
+		for threads in ['1:1:1', '2:2:2', '1:4:2', '2:4:4']:
+			rate = measure(1, threads, None)
+			if rate > best[0]:
+				best = (rate, threads, None)
+		for tile in [128, 256, 512]:
+			rate = measure(1, best[1], tile)
+			if rate > best[0]:
+				best = (rate, best[1], tile)
+		jobs = 1
+		for j in range(2, most + 1):
+			rate = measure(j, best[1], best[2])
+			if rate < best[0] * 1.05: # stop once another job barely helps
+				break
+			best, jobs = (rate, best[1], best[2]), j
+
+	erp.jobs, erp.threads, erp.tile = jobs, best[1], best[2]
+	erp.save_profile(frames[0])
+	print(f'\nSaved Jobs: {jobs}, Threads: {best[1] or "default"}, '
+		f'Tile: {best[2] or "default"} at {best[0]:.3f} calls/s to {cmn.profiles}\n')
 
 def cmd_extract(args: argparse.Namespace) -> None:
 	vid = args.name
@@ -255,24 +626,19 @@ def cmd_render(args: argparse.Namespace) -> None:
 		frames[-1].rename(frames[-1].idx, temp=False)
 
 def cmd_rm(args: argparse.Namespace) -> None:
+	marked: list[cmn.Frame] = []
+	for a in [s.split(':') for s in args.nums]:
+		if len(a) >= 2:
+			marked += cmn.Frames(args.dir, (float(a[0]), float(a[1])))
+		elif len(a) >= 1:
+			marked.append(cmn.Frame(args.dir, float(a[0])))
 	if args.whitelist:
 		# remove list items from list of all frames, then delete leftovers
-		frames = cmn.Frames(args.dir, args.range)
-		for a in [s.split(':') for s in args.nums]:
-			if len(a) >= 2:
-				for x in cmn.Frames(args.dir, (float(a[0]), float(a[1]))):
-					frames.remove(x)
-			elif len(a) >= 1:
-				frames.remove(cmn.Frame(args.dir, float(a[0])))
-		for x in frames:
-			x.remove()
-	else:
-		for a in [s.split(':') for s in args.nums]:
-			if len(a) >= 2:
-				for x in cmn.Frames(args.dir, (float(a[0]), float(a[1]))):
-					x.remove()
-			elif len(a) >= 1:
-				cmn.Frame(args.dir, float(a[0])).remove()
+		keep = { x.idx for x in marked }
+		marked = [x for x in cmn.Frames(args.dir, args.range) if x.idx not in keep]
+	with cmn.FileOps() as ops:
+		for x in marked:
+			ops.remove(x)
 
 def cmd_mv(args: argparse.Namespace) -> None:
 	frames, indexes = [], []
@@ -280,18 +646,16 @@ def cmd_mv(args: argparse.Namespace) -> None:
 		frames.append(cmn.Frame(args.dir, arg[0]))
 		indexes.append(arg[1])
 
-	if args.copy:
-		for i in range(len(frames)):
-			frames[i].copy(indexes[i])
-	else:
-		# give temporary names first to avoid naming collisions
-		for i in range(len(frames)):
-			frames[i].rename(indexes[i], temp=True)
-		for i in range(len(frames)):
-			frames[i].rename(indexes[i], temp=False)
+	with cmn.FileOps() as ops:
+		if args.copy:
+			for i in range(len(frames)):
+				ops.copy(frames[i], indexes[i])
+		else:
+			ops.renames(frames, indexes)
 
 def cmd_run(args: argparse.Namespace) -> None:
 	# text commands are just like normal commands, minus the call to this file
+	total: dict[str, float] = {}
 	with open(args.text, 'r') as f:
 		lines = f.read().splitlines()
 		slc: slice = args.slice if args.slice is not None else slice(None)
@@ -310,7 +674,8 @@ def cmd_run(args: argparse.Namespace) -> None:
 			elif words[0] == 'model' and len(words) == 2:
 				args.model = words[1]
 			elif words[0] == 'pause':
-				input(f'Pause at line {i + 1 + o}: Press a key to continue')
+				if not args.estimate:
+					input(f'Pause at line {i + 1 + o}: Press a key to continue')
 			else:
 				sub = parser.parse_args(words)
 				if sub.func == cmd_generate and args.ease is not None:
@@ -320,9 +685,164 @@ def cmd_run(args: argparse.Namespace) -> None:
 				kw = vars(sub)
 				kw.update({ k:v for k,v in vars(args).items()
 					if k in kw and kw[k] is None })
+				if args.estimate:
+					# only gen is simulated, other commands are skipped
+					if sub.func == cmd_generate:
+						print(f'\n{line}')
+						scale_range(sub)
+						est = estimate(sub)
+						report(est)
+						for k, v in est.items():
+							total[k] = total.get(k, 0) + v
+					continue
 				if args.pause:
 					input(f'Next: `{line}` Press a key to continue')
 				sub.func(sub)
+	if args.estimate and total:
+		print('Total:')
+		report(total)
+
+hangup = Event() # the client of the current request disconnected
+stopping = Event() # the server received SIGTERM
+
+def cmd_serve(args: argparse.Namespace) -> None:
+	import socket, signal, client
+	path = args.socket or client.socket_path()
+	probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		probe.connect(path)
+		sys.exit(f'A server is already listening on {path}')
+	except OSError:
+		if os.path.exists(path):
+			os.remove(path) # stale socket from a server that did not exit cleanly
+	finally:
+		probe.close()
+	server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server.bind(path)
+	os.chmod(path, 0o600)
+	server.listen()
+	print(f'Listening on {path}')
+
+	def terminate(*_) -> None:
+		stopping.set()
+		cmn.cancelled.set()
+		sys.exit(0)
+	signal.signal(signal.SIGTERM, terminate)
+	try:
+		while True:
+			# requests are handled one at a time, since they chdir and share stdio
+			conn, _ = server.accept()
+			try:
+				with conn:
+					serve_request(conn)
+			except KeyboardInterrupt:
+				if not hangup.is_set(): # Ctrl-C in the server's own terminal
+					raise
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
+		os.remove(path)
+
+def serve_request(conn) -> None:
+	import io, socket, signal, threading
+	hangup.clear()
+	cmn.cancelled.clear()
+	running = Lock()
+	busy = True
+	req = json.loads(conn.makefile('rb', buffering=0).readline())
+	stdin_r, stdin_w = os.pipe()
+
+	def pump() -> None:
+		# client bytes are stdin up to a null byte, which marks its end.
+		# The connection closing means the client is gone, so stop the command
+		nonlocal stdin_w
+		try:
+			while chunk := conn.recv(1 << 16):
+				if stdin_w < 0:
+					continue
+				data, sep, _ = chunk.partition(b'\0')
+				os.write(stdin_w, data)
+				if sep:
+					os.close(stdin_w)
+					stdin_w = -1
+		except OSError:
+			pass
+		with running:
+			if busy:
+				hangup.set()
+				cmn.cancelled.set()
+				signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+	# socket.makefile ignores line buffering, so wrap the raw stream instead
+	writer = io.TextIOWrapper(conn.makefile('wb', buffering=0),
+		encoding='utf-8', line_buffering=True, write_through=True)
+	stdio = sys.stdin, sys.stdout, sys.stderr
+	sys.stdout.flush()
+	sys.stderr.flush()
+	# subprocesses such as ffmpeg write straight to the client as well
+	fds = os.dup(1), os.dup(2)
+	os.dup2(conn.fileno(), 1)
+	os.dup2(conn.fileno(), 2)
+	home = os.getcwd()
+	code = 0
+	reader = Thread(target=pump, daemon=True)
+	reader.start()
+	try:
+		try:
+			if req['argv'][:1] == ['serve']:
+				raise ValueError('Cannot serve from within a server')
+			os.chdir(req['cwd'])
+			sys.stdin = os.fdopen(stdin_r, 'r')
+			sys.stdout, sys.stderr = writer, writer
+			main(req['argv'])
+		finally:
+			# pump sends at most one SIGINT, and only before this point
+			with running:
+				busy = False
+	except SystemExit as e:
+		if stopping.is_set():
+			raise
+		if isinstance(e.code, str):
+			print(e.code, file=sys.stderr)
+		code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+	except KeyboardInterrupt:
+		if not hangup.is_set():
+			raise
+	except BrokenPipeError:
+		pass
+	except Exception:
+		traceback.print_exc()
+		code = 1
+	finally:
+		if hangup.is_set():
+			# let interpolation threads of a cancelled command wind down
+			for t in threading.enumerate():
+				if not t.daemon and t is not threading.current_thread():
+					t.join()
+		if sys.stdin is not stdio[0]:
+			sys.stdin.close()
+		else:
+			os.close(stdin_r)
+		sys.stdin, sys.stdout, sys.stderr = stdio
+		os.dup2(fds[0], 1)
+		os.dup2(fds[1], 2)
+		os.close(fds[0])
+		os.close(fds[1])
+		os.chdir(home)
+	if not hangup.is_set():
+		try:
+			writer.write(f'\0{code}')
+			writer.flush()
+		except OSError:
+			pass
+	try:
+		conn.shutdown(socket.SHUT_RDWR) # wakes up pump
+	except OSError:
+		pass
+	reader.join()
+	if stdin_w >= 0:
+		os.close(stdin_w)
 
 ################################################################################
 # Argparse Setup
@@ -400,9 +920,22 @@ opt(cmd, '-i', '--invert', 'Remove if (index %% div) == rem', action='store_true
 cmd = subcommand('prune', cmd_prune, 'Remove duplicate neighboring frames', True)
 opt(cmd, '-t', '--threshold', 'Image distortion threshold', metavar='0', type=eas.Float)
 opt(cmd, '-n', '--dryrun', 'Perform a dry run', action='store_true')
+opt(cmd, '-k', '--cap', 'Read-ahead memory cap in MiB', metavar='0', type=eas.Float)
 
 cmd = subcommand('weigh', cmd_weigh, 'Suggest indexes based on neighboring distortion')
 cmd.add_argument('ranges', help='Frame index ranges', nargs='+', type=Range)
+opt(cmd, '-k', '--cap', 'Read-ahead memory cap in MiB', metavar='0', type=eas.Float)
+
+cmd = subcommand('loop', cmd_loop, 'Find loop points with perceptual hashes', True)
+opt(cmd, '-g', '--gap', 'Minimum loop length in frames', metavar='0', type=int)
+opt(cmd, '-c', '--count', 'Number of candidates to list', metavar='0', type=int)
+opt(cmd, '-a', '--apply', 'Smooth the seam of the best loop with gen',
+	action='store_true')
+opt(cmd, '-t', '--trim', 'Trim the range to the best loop, saving removed frames',
+	action='store_true')
+opt(cmd, '-b', '--backup', 'Backup folder for removed frames', metavar='X',
+	type=cmn.Path)
+opt(cmd, '-k', '--cap', 'Read-ahead memory cap in MiB', metavar='0', type=eas.Float)
 
 cmd = subcommand('gen', cmd_generate, 'Interpolate between existing frames', True,
 	formatter_class=argparse.RawTextHelpFormatter)
@@ -423,6 +956,17 @@ opt(cmd, '-p', '--pause', 'Pause before certain events', action='store_const', c
 opt(cmd, '-s', '--single', 'Generate a single frame', action='store_true')
 opt(cmd, '-o', '--open', 'Use a half-open interval', action='store_true')
 opt(cmd, '-x', '--num', 'Range multiplier', metavar='0', type=eas.Float)
+opt(cmd, '-n', '--estimate', 'Estimate the cost without generating frames',
+	action='store_const', const=True)
+opt(cmd, '-w', '--watch', 'Regenerate segments around edited keyframes,\n'
+	'polling every X seconds (default: 1)', metavar='0', nargs='?', type=eas.Float,
+	const=1.0)
+
+cmd = subcommand('autotune', cmd_autotune, 'Find the fastest gen settings', True)
+opt(cmd, '-m', '--model', 'Flow model', metavar='X')
+opt(cmd, '-j', '--jobs', 'Max number of concurrent processes to try', metavar='0',
+	type=int)
+opt(cmd, '-n', '--calls', 'Interpolations per measurement', metavar='0', type=int)
 
 cmd = subcommand('ren', cmd_render, 'Render a video from frames')
 cmd.add_argument('name', help='Video file name', nargs='?')
@@ -442,10 +986,19 @@ opt(cmd, '-m', '--model', 'Flow model', metavar='X')
 opt(cmd, '-e', '--ease', 'Easing parameters', metavar='X', type=eas.Dict)
 opt(cmd, '-x', '--num', 'Math operand', metavar='0', type=eas.Float)
 opt(cmd, '-p', '--pause', 'Pause after each command', action='store_true')
-if __name__ == '__main__':
-	args = parser.parse_args()
+opt(cmd, '-n', '--estimate', 'Estimate the cost of gen commands without running any',
+	action='store_true')
+
+cmd = subcommand('serve', cmd_serve, 'Keep caches warm and run commands from client.py')
+opt(cmd, '-s', '--socket', 'Unix socket path', metavar='X')
+
+def main(argv: list[str]|None = None) -> None:
+	args = parser.parse_args(argv)
 	# for cmd_run to work, defaults need to be set outside of argparse
 	kw = vars(args)
 	args.dir = kw.get('dir', None) or cmn.Path('frames/')
 	args.backup = kw.get('backup', None) or cmn.Path('backup/')
 	args.func(args)
+
+if __name__ == '__main__':
+	main()